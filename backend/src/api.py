@@ -1,35 +1,234 @@
 import os
 import sys
-from flask import Flask, request, jsonify, abort
+import time
+import hashlib
+from functools import wraps
+from flask import Flask, request, abort
 from sqlalchemy import exc
-import json
+import msgspec
 from flask_cors import CORS
-from ast import literal_eval
+from flask_caching import Cache
+from flask_compress import Compress
 
-from .database.models import db_drop_and_create_all, setup_db, Drink
+from .database.models import (db_drop_and_create_all, setup_db, db, Drink,
+                              drink_rows, cached_short_format,
+                              cached_long_format,
+                              NewDrinkPayload, DrinkUpdatePayload)
 from .auth.auth import AuthError, requires_auth
 
 app = Flask(__name__)
 setup_db(app)
-CORS(app)
 
 # CORS Setup
-@app.after_request
-def after_request(response):
-    response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Methods',
-                         'GET, POST, PATCH, DELETE, OPTIONS')
-    response.headers.add('Access-Control-Allow-Headers',
-                         'Authorization, Content-Type')
+CORS(app, origins='*',
+     methods=['GET', 'POST', 'PATCH', 'DELETE', 'OPTIONS'],
+     allow_headers=['Authorization', 'Content-Type'])
+
+# Cache Setup
+# The default in-process cache is only shared by a single worker; set
+# CACHE_TYPE (e.g. to 'redis', along with CACHE_REDIS_URL, which needs the
+# redis package installed) to share cached responses between several workers.
+app.config['CACHE_TYPE'] = os.environ.get('CACHE_TYPE', 'simple')
+app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL')
+cache = Cache(app)
+
+# How long (in seconds) a cached response is served without re-running the
+# route, and how long it's kept as a fallback for when the database fails.
+RESPONSE_CACHE_TTL = 10
+RESPONSE_CACHE_STALE_TTL = 300
+DRINKS_CACHE_KEYS = ('drinks_short', 'drinks_long')
+
+# Set FAST_PATH=1 to build GET /drinks-detail's body by splicing the stored
+# recipes' JSON into a fixed template, instead of encoding the (memoised)
+# drink structs. The two perform about the same; the fast path uses no cache
+# memory, but skips validating the stored recipes.
+app.config['FAST_PATH'] = os.environ.get('FAST_PATH') == '1'
+
+# Compression Setup
+# Responses of at least 1KB are compressed with brotli or gzip, depending on
+# what the client accepts.
+app.config['COMPRESS_MIN_SIZE'] = 1024
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_LEVEL'] = 4
+app.config['COMPRESS_BR_LEVEL'] = 4
+Compress(app)
+
+
+# Command: flask init-db
+# Description: Initialises the database, dropping any existing tables and
+#              creating them from scratch.
+#              !! NOTE THIS WILL DROP ALL RECORDS
+@app.cli.command('init-db')
+def init_db():
+    db_drop_and_create_all()
+
+
+# Reusable msgspec encoder and decoders. The decoders validate the request
+# bodies against the payload structs while parsing them.
+_ENC = msgspec.json.Encoder()
+_NEW_DRINK_DEC = msgspec.json.Decoder(NewDrinkPayload)
+_DRINK_UPDATE_DEC = msgspec.json.Decoder(DrinkUpdatePayload)
+
+
+# Function: _json
+# Description: Serialises the given payload with msgspec and wraps it in a
+#              JSON response. Used instead of Flask's jsonify, which relies on
+#              the (much slower) standard library json module.
+# Parameters: payload (dict) - The response body.
+#             status (Integer) - The response's status code.
+# Returns: A Flask response object.
+def _json(payload, status=200):
+    return app.response_class(_ENC.encode(payload), status=status,
+                              mimetype='application/json')
+
+
+# Function: get_request_json
+# Description: Parses and validates the request's JSON body with the given
+#              msgspec decoder. The raw body is read through Flask's request
+#              cache, so it's only read once. Aborts with a 400 error if the
+#              body isn't valid JSON or doesn't match the decoder's type.
+# Parameters: decoder (msgspec.json.Decoder) - The decoder for the body.
+# Returns: body - The decoded request body.
+def get_request_json(decoder):
+    try:
+        return decoder.decode(request.get_data(cache=True))
+    except msgspec.DecodeError:
+        abort(400)
+
+
+# Function: _cached_body_response
+# Description: Builds a JSON response from a cached_response entry, with the
+#              entry's ETag.
+# Parameters: entry (tuple) - The cached (timestamp, stale_at, body, status,
+#                             etag) tuple.
+# Returns: A Flask response object.
+def _cached_body_response(entry):
+    response = app.response_class(entry[2], status=entry[3],
+                                  mimetype='application/json')
+    response.set_etag(entry[4], weak=True)
     return response
 
 
-'''
-@TODO uncomment the following line to initialize the datbase
-!! NOTE THIS WILL DROP ALL RECORDS AND START YOUR DB FROM SCRATCH
-!! NOTE THIS MUST BE UNCOMMENTED ON FIRST RUN
-'''
-db_drop_and_create_all()
+# @cached_response() Decorator Definition
+# Description: Caches the route's serialised response body under the given
+#              key, as a (timestamp, stale_at, body, status, etag) tuple. The
+#              ETag is a hash of the body itself, so it always matches the
+#              body it's sent with. Until stale_at, the cached body is
+#              returned without running the route. Afterwards the route runs
+#              again; if the database raises an error, the stale body is
+#              returned instead of an error.
+#              Only successful (200) responses are cached.
+# Parameters: key (string) - The cache key for the route's response.
+# Returns: @cached_response decorator.
+def cached_response(key):
+    def cached_response_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            entry = cache.get(key)
+
+            # If there's a fresh cached response, return it
+            if(entry is not None and time.time() < entry[1]):
+                return _cached_body_response(entry)
+
+            try:
+                response = f(*args, **kwargs)
+            # If the database failed and there's a stale response, return it
+            except exc.SQLAlchemyError:
+                if(entry is None):
+                    raise
+                return _cached_body_response(entry)
+
+            if(response.status_code == 200):
+                body = response.get_data()
+                etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+                response.set_etag(etag, weak=True)
+                timestamp = time.time()
+                cache.set(key, (timestamp, timestamp + RESPONSE_CACHE_TTL,
+                                body, response.status_code, etag),
+                          timeout=RESPONSE_CACHE_STALE_TTL)
+
+            return response
+
+        return wrapper
+    return cached_response_decorator
+
+
+# @etag_response Decorator Definition
+# Description: Makes the route's successful responses conditional on their
+#              weak ETag (set by @cached_response, or otherwise made from the
+#              response body). If the request's If-None-Match header already
+#              contains that ETag, returns an empty 304 (Not Modified)
+#              response instead of the body.
+# Parameters: f - The route function.
+# Returns: The decorated route function.
+def etag_response(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        response = f(*args, **kwargs)
+
+        if(response.status_code != 200):
+            return response
+
+        etag, _ = response.get_etag()
+        if(etag is None):
+            etag = hashlib.blake2b(response.get_data(),
+                                   digest_size=8).hexdigest()
+            response.set_etag(etag, weak=True)
+
+        # Flask-Compress appends the compression algorithm to compressed
+        # responses' ETags, so those variants of the tag are accepted too
+        etags = [etag] + [f'{etag}:{algorithm}'
+                          for algorithm in app.config['COMPRESS_ALGORITHM']]
+
+        # The body (and so the tag) depends on the client's Accept-Encoding,
+        # even when the response ends up not being compressed
+        response.vary.add('Accept-Encoding')
+
+        # If the client already has this version, don't send it again. The
+        # 304 carries the tag variant the client sent (the one a 200 would
+        # have carried), and varies on Accept-Encoding like the 200 does.
+        for tag in etags:
+            if(request.if_none_match.contains_weak(tag)):
+                response = app.response_class(status=304)
+                response.set_etag(tag, weak=True)
+                response.vary.add('Accept-Encoding')
+                break
+
+        return response
+
+    return wrapper
+
+
+# Template for a drink's long form in the FAST_PATH response body, with the
+# drink's ID, JSON-encoded title and stored recipe JSON
+_LONG_DRINK_TMPL = b'{"id":%d,"title":%s,"recipe":%s}'
+
+
+# Function: fast_long_drinks_body
+# Description: Builds GET /drinks-detail's response body by formatting each
+#              row into _LONG_DRINK_TMPL, so neither the rows nor the response
+#              go through a generic JSON encoder. Only the title is encoded
+#              (so it's escaped properly); the recipe JSON is used as stored.
+# Parameters: drinks (list) - The rows returned by drink_rows().
+# Returns: The serialised response body (bytes).
+def fast_long_drinks_body(drinks):
+    rows = b','.join(_LONG_DRINK_TMPL % (drink_id, _ENC.encode(title),
+                                         recipe.encode())
+                     for drink_id, updated_at, title, recipe in drinks)
+    return b''.join((b'{"success":true,"drinks":[', rows, b']}'))
+
+
+# Function: invalidate_drinks_cache
+# Description: Removes the cached drinks lists (the DRINKS_CACHE_KEYS entries,
+#              which also hold their ETags). Has to be called whenever a drink
+#              is added, edited or deleted.
+# Parameters: None.
+# Returns: None.
+def invalidate_drinks_cache():
+    # Each key is deleted separately, as the simple cache's delete_many stops
+    # at the first key that isn't cached
+    for key in DRINKS_CACHE_KEYS:
+        cache.delete(key)
 
 
 # ROUTES
@@ -40,21 +239,20 @@ db_drop_and_create_all()
 # Parameters: None.
 # Authorization: None.
 @app.route('/drinks')
+@etag_response
+@cached_response('drinks_short')
 def get_drinks():
-    drinks = Drink.query.all()
-    drinks_short_format = []
-
-    # Checks whether there are drinks in the database
-    if drinks:
-        # Gets each drink's short data representation
-        for drink in drinks:
-            drinks_short_format.append(drink.short())
-    else:
+    # Only the needed columns are fetched, so no Drink objects are created
+    drinks = drink_rows()
+
+    # If there are no drinks in the database, abort with a 404 error
+    if not drinks:
         abort(404)
 
-    return jsonify({
+    return _json({
                     'success': True,
-                    'drinks': drinks_short_format
+                    'drinks': [cached_short_format(*drink)
+                               for drink in drinks]
     })
 
 
@@ -65,23 +263,25 @@ def get_drinks():
 # Authorization: Requires authorisation, and 'get:drinks-detail' permission.
 @app.route('/drinks-detail')
 @requires_auth('get:drinks-detail')
+@etag_response
+@cached_response('drinks_long')
 def get_drink_details(jwt):
-    # Get all the drinks
-    drinks = Drink.query.all()
-    drinks_long = []
-
-    # Checks whether there are drinks in the database
-    if drinks:
-        # Create a list with the drinks' long recipes
-        for drink in drinks:
-            drinks_long.append(drink.long())
-    else:
+    # Get all the drinks' columns, without creating Drink objects
+    drinks = drink_rows()
+
+    # If there are no drinks in the database, abort with a 404 error
+    if not drinks:
         abort(404)
 
-    # Return the list
-    return jsonify({
+    if(app.config['FAST_PATH']):
+        return app.response_class(fast_long_drinks_body(drinks),
+                                  mimetype='application/json')
+
+    # Return the list of the drinks' long recipes
+    return _json({
                     'success': True,
-                    'drinks': drinks_long
+                    'drinks': [cached_long_format(*drink)
+                               for drink in drinks]
     })
 
 
@@ -93,28 +293,28 @@ def get_drink_details(jwt):
 @requires_auth('post:drinks')
 def add_new_drink(jwt):
     # Get the drink details from the request
-    drink_details = json.loads(request.data)
+    drink_details = get_request_json(_NEW_DRINK_DEC)
     drink_return = []
-    all_drinks = Drink.query.all()
-
-    # If the drink name already exists in the database, abort
-    for drink in all_drinks:
-        if(drink.title == drink_details['title']):
-            abort(409)
-
-    drink = Drink(title=drink_details['title'],
-                  recipe=json.dumps(drink_details['recipe']))
+    drink = Drink(title=drink_details.title,
+                  recipe=msgspec.to_builtins(drink_details.recipe))
 
     # Try to add the drink to the database
     try:
         drink.insert()
+        invalidate_drinks_cache()
         drink_return.append(drink.long())
-    # In case of an error, abort with status code 500
+    # If the drink name already exists in the database, the unique constraint
+    # on the title column fails the insert, so abort with status code 409
+    except exc.IntegrityError:
+        db.session.rollback()
+        abort(409)
+    # In case of any other error, abort with status code 500
     except Exception as e:
+        db.session.rollback()
         print(sys.exc_info())
         abort(500)
 
-    return jsonify({
+    return _json({
                     'success': True,
                     'drinks': drink_return
     })
@@ -126,63 +326,44 @@ def add_new_drink(jwt):
 # Parameters: drink_id (Integer).
 #             jwt - JSON Web Token.
 # Authorization: Requires authorisation, and 'patch:drinks' permission.
-@app.route('/drinks/<drink_id>', methods=['PATCH'])
+@app.route('/drinks/<int:drink_id>', methods=['PATCH'])
 @requires_auth('patch:drinks')
 def edit_drink(jwt, drink_id):
-    updated_drink = json.loads(request.data)
-    drink = Drink.query.filter(Drink.id == drink_id).one_or_none()
+    updated_drink = get_request_json(_DRINK_UPDATE_DEC)
+    drink = Drink.query.get(drink_id)
     drink_return = []
 
     # If the drink doesn't exist in the database, abort with a 404 error
     if(drink is None):
         abort(404)
 
-    if('title' in updated_drink):
+    if(updated_drink.title is not None):
         # If the drink's name has changed, update the drink's name
-        if(drink.title != updated_drink['title']):
-            drink.title = updated_drink['title']
-
-    # If the user included a new recipe
-    if('recipe' in updated_drink):
-        # Gets the new and old recipes
-        drink_recipe = literal_eval(drink.recipe)
-        updated_recipe = updated_drink['recipe']
-
-        # Checks whether one of the recipes is longer than the other. If it is,
-        # it means the user either added or deleted ingredients, so the number
-        # of ingredients needs to be updated.
-        if(len(drink_recipe) > len(updated_recipe)):
-            del drink_recipe[len(updated_recipe):len(drink_recipe)]
-        # If the new recipe is longer, gets the difference between the new
-        # recipe and the old one and adds placeholders for the new ingredients.
-        # The new ingredients are then added in the update loop below.
-        elif(len(drink_recipe) < len(updated_recipe)):
-            difference = len(updated_recipe) - len(drink_recipe)
-            for i in range(difference):
-                drink_recipe.append({
-                                    'name': 'name',
-                                    'color': 'color',
-                                    'parts': 1
-                                    })
-
-        # Updates the recipe according to the new recipe
-        for i in range(len(drink_recipe)):
-            drink_recipe[i]['name'] = updated_recipe[i]['name']
-            drink_recipe[i]['color'] = updated_recipe[i]['color']
-            drink_recipe[i]['parts'] = updated_recipe[i]['parts']
-
-        # Replaces the recipe with the new recipe
-        drink.recipe = str(drink_recipe)
+        if(drink.title != updated_drink.title):
+            drink.title = updated_drink.title
+
+    # If the user included a new recipe, replaces the old recipe with it.
+    # Decoding the payload already kept only the ingredients' name, colour
+    # and parts.
+    if(updated_drink.recipe is not None):
+        drink.recipe = msgspec.to_builtins(updated_drink.recipe)
 
     # Try to update the recipe in the database
     try:
         drink.update()
+        invalidate_drinks_cache()
         drink_return.append(drink.long())
-    # If there's an error, abort
+    # If the new name already belongs to another drink, the unique constraint
+    # on the title column fails the update, so abort with status code 409
+    except exc.IntegrityError:
+        db.session.rollback()
+        abort(409)
+    # If there's any other error, abort
     except Exception as e:
+        db.session.rollback()
         abort(500)
 
-    return jsonify({
+    return _json({
                     'success': True,
                     'drinks': drink_return
     })
@@ -193,23 +374,24 @@ def edit_drink(jwt, drink_id):
 # Parameters: drink_id (Integer).
 #             jwt - JSON Web Token.
 # Authorization: Requires authorisation, and 'delete:drinks' permission.
-@app.route('/drinks/<drink_id>', methods=['DELETE'])
+@app.route('/drinks/<int:drink_id>', methods=['DELETE'])
 @requires_auth('delete:drinks')
 def delete_drink(jwt, drink_id):
-    drink = Drink.query.filter(Drink.id == drink_id).one_or_none()
-
-    # If there's no drink with that ID
-    if(drink is None):
-        abort(404)
-
     # Try to delete the drink from the database
     try:
-        drink.delete()
+        deleted = Drink.delete_by_id(drink_id)
     # If there's an error, abort
     except Exception as e:
+        db.session.rollback()
         abort(500)
 
-    return jsonify({
+    # If there's no drink with that ID
+    if(deleted == 0):
+        abort(404)
+
+    invalidate_drinks_cache()
+
+    return _json({
                     'success': True,
                     'delete': drink_id
     })
@@ -217,72 +399,76 @@ def delete_drink(jwt, drink_id):
 
 # Error Handling
 # ---------------------------------------------------------------------------#
+# Function: _error_body
+# Description: Serialises the body of an error response. Used to build the
+#              static error bodies below once, at import time.
+# Parameters: status (Integer) - The error's status code.
+#             message (string) - The error message.
+# Returns: The serialised response body (bytes).
+def _error_body(status, message):
+    return _ENC.encode({
+                        'success': False,
+                        'error': status,
+                        'message': message
+                        })
+
+
+_ERR_400_BODY = _error_body(400, 'Bad request. Check your request format.')
+_ERR_404_BODY = _error_body(404, 'The resource you asked for was not found.')
+_ERR_405_BODY = _error_body(405, 'Method not allowed.')
+_ERR_409_BODY = _error_body(409, 'Conflict. The resource you were trying to '
+                                 'create already exists.')
+_ERR_422_BODY = _error_body(422, 'unprocessable')
+_ERR_500_BODY = _error_body(500, 'An internal server error occurred.')
+
+
 # Error handler for Bad Request (400) error.
 @app.errorhandler(400)
 def bad_request(error):
-    return jsonify({
-                    'success': False,
-                    'error': 400,
-                    'message': 'Bad request. Check your request format.'
-                    }), 400
+    return app.response_class(_ERR_400_BODY, status=400,
+                              mimetype='application/json')
 
 
 # Error handler for Not Found (404) error.
 @app.errorhandler(404)
 def not_found(error):
-    return jsonify({
-                    'success': False,
-                    'error': 404,
-                    'message': 'The resource you asked for was not found.'
-                    }), 404
+    return app.response_class(_ERR_404_BODY, status=404,
+                              mimetype='application/json')
 
 
 # Error handler for Method Not Allowed (405) error.
 @app.errorhandler(405)
 def method_not_allowed(error):
-    return jsonify({
-                    'success': False,
-                    'error': 405,
-                    'message': 'Method not allowed.'
-                    }), 405
+    return app.response_class(_ERR_405_BODY, status=405,
+                              mimetype='application/json')
 
 
 # Error handler for Conflict (409) error.
 @app.errorhandler(409)
 def conflict(error):
-    return jsonify({
-                    'success': False,
-                    'error': 409,
-                    'message': 'Conflict. The resource you were trying to\
-                                create already exists.'
-                    }), 409
+    return app.response_class(_ERR_409_BODY, status=409,
+                              mimetype='application/json')
 
 
 # Error handler for Unprocessable (422) error.
 @app.errorhandler(422)
 def unprocessable(error):
-    return jsonify({
-                    "success": False,
-                    "error": 422,
-                    "message": "unprocessable"
-                    }), 422
+    return app.response_class(_ERR_422_BODY, status=422,
+                              mimetype='application/json')
 
 
 # Error handler for Internal Server Error (500).
 @app.errorhandler(500)
 def internal_server(error):
-    return jsonify({
-                    'success': False,
-                    'error': 500,
-                    'message': 'An internal server error occurred.'
-                    }), 500
+    return app.response_class(_ERR_500_BODY, status=500,
+                              mimetype='application/json')
 
 
 # Error handler for authentication error.
 @app.errorhandler(AuthError)
 def auth_error(error):
-    return jsonify({
+    return _json({
                     'success': False,
                     'error': error.status_code,
                     'message': error.error['description']
-                    }), error.status_code
+                    }, error.status_code)
@@ -1,171 +1,397 @@
-import json
-from flask import request, _request_ctx_stack
+import time
+import asyncio
+import hashlib
+import threading
+import weakref
+from types import MappingProxyType
 from functools import wraps
-from jose import jwt
-from urllib.request import urlopen
+from cachetools import TLRUCache
+import requests
+from requests.adapters import HTTPAdapter
+import httpx
+import jwt
+from jwt.algorithms import RSAAlgorithm
+
+# The per-request header and permission checks live in auth_hot, which can be
+# compiled with mypyc (see the README); they're re-exported from here
+from .auth_hot import (AuthError, get_token_auth_header, check_permissions,
+                       _ERR_INVALID_TOKEN, _ERR_EXPIRED, _ERR_INVALID_CLAIMS,
+                       _ERR_INVALID_SIGNATURE, _ERR_JWKS_UNAVAILABLE)
 
 
 AUTH0_DOMAIN = 'dev-sbac.auth0.com'
-ALGORITHMS = ['RS256']
+ALGORITHMS = ('RS256',)
 API_AUDIENCE = 'coffeeshop'
 
+# The tokens' expected issuer and the JWKS's URL, built once from the domain
+_ISSUER = f'https://{AUTH0_DOMAIN}/'
+_JWKS_URL = f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+
+# How long (in seconds) the fetched JWKS is cached before it's fetched again
+_JWKS_TTL = 600
+# The cached JWKS public keys (parsed once per fetch), indexed by key ID
+_JWKS_INDEX = {}
+_JWKS_CACHE_TS = 0.0
+_JWKS_LOCK = threading.Lock()
+# The cached JWKS's ETag, sent back to Auth0 so it can reply with a 304 (Not
+# Modified) if the JWKS hasn't changed
+_JWKS_ETAG = None
+# The minimum time (in seconds) between forced refetches of the JWKS, so
+# tokens with made-up key IDs can't make the server flood Auth0 with requests
+_JWKS_REFRESH_INTERVAL = 30
+_LAST_REFRESH_TS = float('-inf')
+# How long (in seconds) to wait before fetching the JWKS again after a fetch
+# failed. Until then, the cached keys (if any) keep being used.
+_JWKS_RETRY_INTERVAL = 10
+_JWKS_RETRY_TS = float('-inf')
+
+# A pooled HTTP session for fetching the JWKS, so refetches reuse the open
+# connection to Auth0 instead of going through a new TLS handshake
+_HTTP = requests.Session()
+_HTTP.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+# The locks used by _aget_jwks. An asyncio lock only works in the event loop
+# it's used in, so there's one per loop (dropped along with its loop).
+_AJWKS_LOCKS = weakref.WeakKeyDictionary()
+
+# The claims every token must have; they're checked while decoding the token
+_DECODE_OPTIONS = {
+    'require': ['exp', 'aud', 'iss']
+}
+
+# The longest token that's accepted; Auth0's access tokens are far shorter
+_MAX_TOKEN_LENGTH = 8192
+
+# Verified token payloads, keyed by the SHA-256 hash of the token (the token
+# itself is never stored). Each payload is cached until its token expires,
+# for at most _PAYLOAD_CACHE_TTL seconds.
+_PAYLOAD_CACHE_TTL = 300
+_PAYLOAD_CACHE = TLRUCache(maxsize=10000,
+                           ttu=lambda key, payload, now:
+                               min(payload.get('exp', now),
+                                   now + _PAYLOAD_CACHE_TTL),
+                           timer=time.time)
+_PAYLOAD_CACHE_LOCK = threading.RLock()
+
+
+# Function: _jwks_needs_fetch
+# Description: Checks whether the JWKS has to be fetched from Auth0. It does
+#              if it isn't cached or the cached copy is older than _JWKS_TTL.
+#              A forced refresh fetches it unless it was already fetched in
+#              the last _JWKS_REFRESH_INTERVAL seconds. Nothing is fetched
+#              within _JWKS_RETRY_INTERVAL seconds of a failed fetch.
+# Parameters: force_refresh (boolean) - Whether a refresh is forced.
+#             cache_ts (float) - The time the cached JWKS was fetched.
+# Returns: A boolean indicating whether to fetch the JWKS.
+def _jwks_needs_fetch(force_refresh, cache_ts):
+    now = time.monotonic()
+
+    if(now < _JWKS_RETRY_TS):
+        return False
+
+    if(force_refresh):
+        return now - _LAST_REFRESH_TS >= _JWKS_REFRESH_INTERVAL
+
+    return not _JWKS_INDEX or now - cache_ts >= _JWKS_TTL
+
+
+# Function: _cached_jwks
+# Description: Gets the cached JWKS keys, for when the JWKS isn't fetched.
+#              If there are no cached keys because fetching them failed,
+#              raises an AuthError (503), as no token can be verified.
+# Parameters: None
+# Returns: _JWKS_INDEX - A dict mapping each key's ID to its public key.
+def _cached_jwks():
+    if(not _JWKS_INDEX and time.monotonic() < _JWKS_RETRY_TS):
+        raise AuthError(_ERR_JWKS_UNAVAILABLE, 503)
+
+    return _JWKS_INDEX
+
+
+# Function: _jwks_fetch_failed
+# Description: Handles a failed JWKS fetch: the next fetch is put off for
+#              _JWKS_RETRY_INTERVAL seconds, and the cached keys are used
+#              until then.
+# Parameters: None
+# Returns: _JWKS_INDEX - A dict mapping each key's ID to its public key.
+def _jwks_fetch_failed():
+    global _JWKS_RETRY_TS
+
+    _JWKS_RETRY_TS = time.monotonic() + _JWKS_RETRY_INTERVAL
+
+    return _cached_jwks()
+
+
+# Function: _store_jwks
+# Description: Caches the JWKS from Auth0's response (either a requests or an
+#              httpx response). Each key is parsed into an RSA public key once
+#              per fetch, so finding a token's key is a single dict lookup and
+#              verifying a token doesn't parse the JWK again. If Auth0 replied
+#              with a 304 (Not Modified), the cached keys are kept. Keys that
+#              can't verify RS256 tokens (non-RSA or encryption keys) and
+#              malformed keys are left out, so they can't fail a whole fetch.
+# Parameters: response - The response to the JWKS request.
+# Returns: _JWKS_INDEX - A dict mapping each key's ID to its public key.
+def _store_jwks(response):
+    global _JWKS_INDEX, _JWKS_CACHE_TS, _JWKS_ETAG
 
-# AuthError Exception
-# A standardized way to communicate auth failure modes
-class AuthError(Exception):
-    def __init__(self, error, status_code):
-        self.error = error
-        self.status_code = status_code
+    # If the JWKS hasn't changed, keeps using the cached keys
+    if(response.status_code == 304 and _JWKS_INDEX):
+        _JWKS_CACHE_TS = time.monotonic()
+        return _JWKS_INDEX
 
+    response.raise_for_status()
+    jwks = response.json()
+    index = {}
+    for key in jwks['keys']:
+        if(key.get('kty') != 'RSA' or key.get('use', 'sig') != 'sig' or
+           not isinstance(key.get('kid'), str)):
+            continue
+        try:
+            index[key['kid']] = RSAAlgorithm.from_jwk(key)
+        except (jwt.PyJWTError, ValueError):
+            continue
+
+    _JWKS_INDEX = index
+    # The ETag is only kept along with usable keys; otherwise a 304 would
+    # leave nothing to verify tokens with
+    _JWKS_ETAG = response.headers.get('ETag') if index else None
+    _JWKS_CACHE_TS = time.monotonic()
+
+    return _JWKS_INDEX
+
+
+# Function: _get_jwks
+# Description: Gets the keys from the Auth0 JWKS (JSON Web Key Set), indexed
+#              by their key IDs. The JWKS is only fetched from Auth0 if it
+#              isn't cached, if the cached copy is older than _JWKS_TTL, or if
+#              a refresh is forced (e.g. when a token is signed with a key
+#              that isn't in the cached JWKS, as happens after Auth0 rotates
+#              its keys). Only one thread fetches the JWKS at a time; threads
+#              that were waiting on it use the keys it fetched instead of
+#              fetching them again. Forced refreshes are limited to one per
+#              _JWKS_REFRESH_INTERVAL; until then, forcing a refresh returns
+#              the cached keys. If Auth0 can't be reached (or sends an invalid
+#              JWKS), the cached keys keep being used.
+# Parameters: force_refresh (boolean) - Whether to refetch the JWKS even if
+#                                       the cached copy is still valid.
+# Returns: _JWKS_INDEX - A dict mapping each key's ID to its public key.
+def _get_jwks(force_refresh=False):
+    global _LAST_REFRESH_TS
+
+    # If the cached JWKS can be used, return it without taking the lock
+    if(not _jwks_needs_fetch(force_refresh, _JWKS_CACHE_TS)):
+        return _cached_jwks()
+
+    with _JWKS_LOCK:
+        # If another thread fetched the JWKS (or failed to) while this one
+        # was waiting for the lock, use the cached keys
+        if(not _jwks_needs_fetch(force_refresh, _JWKS_CACHE_TS)):
+            return _cached_jwks()
+
+        _LAST_REFRESH_TS = time.monotonic()
+        headers = {'If-None-Match': _JWKS_ETAG} if _JWKS_ETAG else {}
+
+        try:
+            response = _HTTP.get(_JWKS_URL, headers=headers, timeout=2)
+            return _store_jwks(response)
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            return _jwks_fetch_failed()
 
-# Auth Header
 
-# Function: get_token_auth_header
-# Description: Gets the request's 'Authorization' header. Checks to see whether
-#              said header exists; whether the header is comprised of two
-#              parts; and whether the first part is 'bearer'. This serves as
-#              preliminary verification that the JWT is in the correct form.
+# Function: _aget_jwks
+# Description: The async version of _get_jwks, for use in async views. The
+#              JWKS is fetched with httpx, so waiting for Auth0 doesn't block
+#              the event loop. The cached keys are shared with _get_jwks.
+#              Nothing async outlives the call's event loop: the lock is the
+#              loop's own, and the HTTP client is only opened for the fetch,
+#              since async views (e.g. Flask's) may run each request in a new
+#              loop.
+# Parameters: force_refresh (boolean) - Whether to refetch the JWKS even if
+#                                       the cached copy is still valid.
+# Returns: _JWKS_INDEX - A dict mapping each key's ID to its public key.
+async def _aget_jwks(force_refresh=False):
+    global _LAST_REFRESH_TS
+
+    # If the cached JWKS can be used, return it without taking the lock
+    if(not _jwks_needs_fetch(force_refresh, _JWKS_CACHE_TS)):
+        return _cached_jwks()
+
+    loop = asyncio.get_running_loop()
+    lock = _AJWKS_LOCKS.get(loop)
+    if(lock is None):
+        lock = _AJWKS_LOCKS[loop] = asyncio.Lock()
+
+    async with lock:
+        # If another task fetched the JWKS (or failed to) while this one
+        # was waiting for the lock, use the cached keys
+        if(not _jwks_needs_fetch(force_refresh, _JWKS_CACHE_TS)):
+            return _cached_jwks()
+
+        _LAST_REFRESH_TS = time.monotonic()
+        headers = {'If-None-Match': _JWKS_ETAG} if _JWKS_ETAG else {}
+
+        try:
+            async with httpx.AsyncClient(timeout=2.0) as client:
+                response = await client.get(_JWKS_URL, headers=headers)
+            return _store_jwks(response)
+        except (httpx.HTTPError, ValueError, KeyError, TypeError):
+            return _jwks_fetch_failed()
+
+
+# Function: prewarm_jwks
+# Description: Fetches the JWKS ahead of the first authenticated request, so
+#              that request doesn't have to wait for it. If Auth0 can't be
+#              reached, the JWKS is fetched on the first authenticated request
+#              instead; the failed prewarm doesn't hold that fetch back.
 # Parameters: None
-# Returns: auth_list[1] - The JSON web token.
-def get_token_auth_header():
-    # Checks whether the authorisation header is in the request. If not,
-    # raises an authorisation error.
-    if('Authorization' not in request.headers):
-        raise AuthError({
-                        'code': 401,
-                        'description': 'Unauthorised. No Authorization header.'
-                        }, 401)
-
-    auth_header = request.headers.get('Authorization')
-    auth_list = auth_header.split(" ")
-
-    # Checks whether the authorisation header contains two parts. If not,
-    # raises an authorisation error.
-    if(len(auth_list) != 2):
-        raise AuthError({
-                        'code': 401,
-                        'description': 'Unauthorised. \
-                                        Malformed Authorization header.'
-                        }, 401)
-
-    # Checks whether the first part of the authorisation header is the word
-    # 'bearer'. If not, raises an authorisation error.
-    if(auth_list[0].lower() != 'bearer'):
-        raise AuthError({
-                        'code': 401,
-                        'description': 'Unauthorised.\
-                                        Malformed Authorization header.'
-                        }, 401)
-
-    return auth_list[1]
+# Returns: A boolean indicating whether the JWKS was fetched.
+def prewarm_jwks():
+    global _JWKS_RETRY_TS
+
+    try:
+        _get_jwks()
+    except AuthError:
+        _JWKS_RETRY_TS = float('-inf')
+        return False
+
+    return True
+
+
+# Function: _check_token
+# Description: Runs the checks that come before verifying the token's
+#              signature: rejects tokens that aren't in the JWT format, looks
+#              the token up in the verified payloads' cache and gets the ID of
+#              the key the token was signed with.
+# Parameters: token - a JSON Web Token.
+# Returns: token_hash - The SHA-256 hash of the token.
+#          payload - The token's cached payload (or None if it isn't cached).
+#          kid - The ID of the token's key (or None if the payload is cached).
+def _check_token(token):
+    # A JWT is three dot-separated parts, so anything else (or an overly long
+    # token) is rejected without being hashed or decoded
+    if(len(token) > _MAX_TOKEN_LENGTH or token.count('.') != 2):
+        raise AuthError(_ERR_INVALID_TOKEN, 401)
+
+    token_hash = hashlib.sha256(token.encode()).digest()
+
+    # If the token was already verified (and hasn't expired since), skips
+    # verifying its signature again
+    with _PAYLOAD_CACHE_LOCK:
+        payload = _PAYLOAD_CACHE.get(token_hash)
+    if payload is not None:
+        return token_hash, payload, None
+
+    try:
+        token_header = jwt.get_unverified_header(token)
+    except jwt.PyJWTError:
+        raise AuthError(_ERR_INVALID_TOKEN, 401)
+
+    kid = token_header.get('kid')
+
+    # If the 'kid' key doesn't exist in the token header (or isn't a string,
+    # and so can't be looked up in the JWKS)
+    if(not isinstance(kid, str)):
+        raise AuthError(_ERR_INVALID_TOKEN, 401)
+
+    return token_hash, None, kid
+
+
+# Function: _decode_token
+# Description: Decodes the token and verifies its signature and claims using
+#              the given public key, then caches its payload.
+# Parameters: token - a JSON Web Token.
+#             token_hash - The SHA-256 hash of the token.
+#             public_key - The public key the token was signed with (or None
+#                          if it isn't in the JWKS).
+# Returns: payload - The payload from the decoded token, as a read-only
+#                    mapping.
+def _decode_token(token, token_hash, public_key):
+    # If the key isn't in the JWKS, the token wasn't signed by Auth0
+    if public_key is None:
+        raise AuthError(_ERR_INVALID_TOKEN, 401)
+
+    # Try to decode and validate the JWT
+    try:
+        payload = jwt.decode(
+            token,
+            public_key,
+            algorithms=ALGORITHMS,
+            audience=API_AUDIENCE,
+            issuer=_ISSUER,
+            options=_DECODE_OPTIONS
+        )
+    # If the signature expired
+    except jwt.ExpiredSignatureError:
+        raise AuthError(_ERR_EXPIRED, 401)
+    # If any claim(s) is (are) invalid or missing
+    except (jwt.InvalidAudienceError, jwt.InvalidIssuerError,
+            jwt.InvalidIssuedAtError, jwt.ImmatureSignatureError,
+            jwt.MissingRequiredClaimError):
+        raise AuthError(_ERR_INVALID_CLAIMS, 401)
+    # If the JWT signature is invalid
+    except jwt.PyJWTError:
+        raise AuthError(_ERR_INVALID_SIGNATURE, 401)
+
+    # Converts the permissions to a frozenset, so checking for a permission
+    # is a hash lookup instead of a list scan, and any other list claim (e.g.
+    # a list of audiences) to a tuple
+    for claim, value in payload.items():
+        if(isinstance(value, list)):
+            payload[claim] = (frozenset(value) if claim == 'permissions'
+                              else tuple(value))
+
+    # The same payload is returned for every request with this token, so it's
+    # made read-only; otherwise a route changing it would change what later
+    # requests see
+    payload = MappingProxyType(payload)
+
+    # Only successfully verified tokens get here, so invalid tokens are
+    # always verified again
+    with _PAYLOAD_CACHE_LOCK:
+        _PAYLOAD_CACHE[token_hash] = payload
+
+    return payload
 
 
 # Function: verify_decode_jwt
 # Description: Gets the token and attempts to decode and verify it using the
 #              Auth0 JWKS (JSON Web Key Set) JSON. Ensures that the JWT is
-#              authentic, still valid and hasn't been tampered with.
+#              authentic, still valid and hasn't been tampered with. The
+#              payloads of verified tokens are cached, so a token that's
+#              reused across requests is only verified once.
 # Parameters: token - a JSON Web Token.
 # Returns: payload - The payload from the decoded token.
 def verify_decode_jwt(token):
-    # Gets the JWKS json to decode the JWT
-    jsonurl = urlopen(f'https://' + AUTH0_DOMAIN + '/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    token_hash, payload, kid = _check_token(token)
+    if payload is not None:
+        return payload
 
-    try:
-        token_header = jwt.get_unverified_header(token)
-    except Exception as e:
-        raise AuthError({
-                        'code': 401,
-                        'description': 'Unauthorised. Invalid token.'
-                        }, 401)
-
-    rsa_key = {}
-
-    # If the 'kid' key doesn't exist in the token header
-    if('kid' not in token_header):
-        raise AuthError({
-                        'code': 401,
-                        'description': 'Unauthorised. Invalid token.'
-                        }, 401)
-
-    # Gets the JWKS from the JSON
-    for key in jwks['keys']:
-        if key['kid'] == token_header['kid']:
-            rsa_key = {
-                    'kty': key['kty'],
-                    'kid': key['kid'],
-                    'use': key['use'],
-                    'n': key['n'],
-                    'e': key['e']
-                }
+    # Gets the token's key from the (cached) JWKS. If it's not there, Auth0
+    # might have rotated its keys, so the JWKS is fetched again once (unless
+    # it was already fetched in the last _JWKS_REFRESH_INTERVAL seconds).
+    public_key = _get_jwks().get(kid)
+    if public_key is None:
+        public_key = _get_jwks(force_refresh=True).get(kid)
 
-    # Try to decode and validate the JWT
-    if rsa_key:
-        try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
-        # If the signature expired
-        except jwt.ExpiredSignatureError:
-            raise AuthError({
-                            'code': 401,
-                            'description': 'Unauthorised. The token expired.'
-                            }, 401)
-        # If any claim(s) is (are) invalid
-        except jwt.JWTClaimsError:
-            raise AuthError({
-                            'code': 401,
-                            'description': 'Unauthorised. Claims are invalid.'
-                            }, 401)
-        # If the JWT signature is invalid
-        except jwt.JWTError:
-            raise AuthError({
-                            'code': 401,
-                            'description':
-                            'Unauthorised. Signature is invalid.'
-                            }, 401)
-        # If there was any other error decoding the JWT
-        except Exception as e:
-            raise AuthError({
-                            'code': 401,
-                            'description': 'Unauthorised. Invalid token.'
-                            }, 401)
+    return _decode_token(token, token_hash, public_key)
 
-    return payload
 
+# Function: averify_decode_jwt
+# Description: The async version of verify_decode_jwt, for use in async
+#              views. Only fetching the JWKS is asynchronous; when the keys
+#              are cached, no awaiting happens at all.
+# Parameters: token - a JSON Web Token.
+# Returns: payload - The payload from the decoded token.
+async def averify_decode_jwt(token):
+    token_hash, payload, kid = _check_token(token)
+    if payload is not None:
+        return payload
 
-# Function: check_permissions
-# Description: Checks the payload from of the decoded, verified JWT for
-#              permissions. Then compares the user's permissions to the
-#              required permission to check whether the user is allowed to
-#              access the given resource.
-# Parameters: permission (string) - The resource's required permission.
-#             payload - The payload from the decoded, verified JWT.
-# Returns: True - Boolean confirming the user has the required permission.
-def check_permissions(permission, payload):
-    # If there are no permissions in the payload, raises an AuthError
-    if('permissions' not in payload):
-        raise AuthError({
-                        'code': 403,
-                        'description':
-                        'You do not have permission to perform that action.'
-                        }, 403)
-
-    user_permissions = payload['permissions']
-
-    # If the needed permission isn't in the user's permissions, raises an error
-    if(permission not in user_permissions):
-        raise AuthError({
-                        'code': 403,
-                        'description':
-                        'You do not have permission to perform that action.'
-                        }, 403)
+    public_key = (await _aget_jwks()).get(kid)
+    if public_key is None:
+        public_key = (await _aget_jwks(force_refresh=True)).get(kid)
 
-    return True
+    return _decode_token(token, token_hash, public_key)
 
 
 # @requires_auth() Decorator Definition
@@ -175,12 +401,44 @@ def check_permissions(permission, payload):
 # Returns: @requires_auth decorator.
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
+        # The helper functions and the permission are bound as keyword-only
+        # defaults, so the wrapper looks them up as locals instead of globals.
+        # Routes without a required permission get a wrapper that doesn't
+        # check permissions at all.
+        if(not permission):
+            @wraps(f)
+            def wrapper(*args, _get=get_token_auth_header,
+                        _verify=verify_decode_jwt, **kwargs):
+                return f(_verify(_get()), *args, **kwargs)
+
+            return wrapper
+
         @wraps(f)
-        def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+        def wrapper(*args, _get=get_token_auth_header,
+                    _verify=verify_decode_jwt, _check=check_permissions,
+                    _perm=permission, **kwargs):
+            payload = _verify(_get())
+            _check(_perm, payload)
             return f(payload, *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
+
+
+# @arequires_auth() Decorator Definition
+# Description: The async version of @requires_auth, for async views. Verifies
+#              the JWT with averify_decode_jwt, so fetching the JWKS doesn't
+#              block the event loop. The header is read from Flask's request,
+#              so this needs a Flask version with async views (2.0+).
+# Parameters: permission (string) - The resource's required permission.
+# Returns: @arequires_auth decorator.
+def arequires_auth(permission=''):
+    def arequires_auth_decorator(f):
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            payload = await averify_decode_jwt(get_token_auth_header())
+            check_permissions(permission, payload)
+            return await f(payload, *args, **kwargs)
+
+        return wrapper
+    return arequires_auth_decorator
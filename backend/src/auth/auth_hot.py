@@ -0,0 +1,110 @@
+# The auth checks that run on every request, kept in their own module so
+# they can be compiled with mypyc. They're fully type-annotated for that, and
+# only use the standard library and Flask's request.
+from typing import Mapping
+from flask import request  # type: ignore
+
+
+# The accepted casings of the Authorization header's scheme, so checking the
+# scheme doesn't need a lowercased copy of it
+_BEARER_SCHEMES = frozenset(('bearer', 'Bearer', 'BEARER'))
+
+
+# AuthError Exception
+# A standardized way to communicate auth failure modes
+class AuthError(Exception):
+    def __init__(self, error: dict, status_code: int) -> None:
+        self.error = error
+        self.status_code = status_code
+
+
+# AuthError payloads, defined once so failed requests don't build new ones
+_ERR_NO_HEADER = {
+    'code': 401,
+    'description': 'Unauthorised. No Authorization header.'
+}
+_ERR_MALFORMED_HEADER = {
+    'code': 401,
+    'description': 'Unauthorised. Malformed Authorization header.'
+}
+_ERR_INVALID_TOKEN = {
+    'code': 401,
+    'description': 'Unauthorised. Invalid token.'
+}
+_ERR_EXPIRED = {
+    'code': 401,
+    'description': 'Unauthorised. The token expired.'
+}
+_ERR_INVALID_CLAIMS = {
+    'code': 401,
+    'description': 'Unauthorised. Claims are invalid.'
+}
+_ERR_INVALID_SIGNATURE = {
+    'code': 401,
+    'description': 'Unauthorised. Signature is invalid.'
+}
+_ERR_JWKS_UNAVAILABLE = {
+    'code': 503,
+    'description': 'Service unavailable. Could not get the keys to verify '
+                   'the token.'
+}
+_ERR_FORBIDDEN = {
+    'code': 403,
+    'description': 'You do not have permission to perform that action.'
+}
+
+
+# Auth Header
+
+# Function: get_token_auth_header
+# Description: Gets the request's 'Authorization' header. Checks to see whether
+#              said header exists; whether the header is comprised of two
+#              parts; and whether the first part is 'bearer'. This serves as
+#              preliminary verification that the JWT is in the correct form.
+# Parameters: None
+# Returns: token - The JSON web token.
+def get_token_auth_header() -> str:
+    # Checks whether the authorisation header is in the request. If not,
+    # raises an authorisation error.
+    if('Authorization' not in request.headers):
+        raise AuthError(_ERR_NO_HEADER, 401)
+
+    auth_header: str = request.headers.get('Authorization')
+    # Splits the header at its first space only, without building a list
+    scheme, sep, token = auth_header.partition(' ')
+
+    # Checks whether the authorisation header contains exactly two parts and
+    # whether the first part is the word 'bearer'. If not, raises an
+    # authorisation error.
+    if(not sep or not token or ' ' in token or
+       scheme not in _BEARER_SCHEMES):
+        raise AuthError(_ERR_MALFORMED_HEADER, 401)
+
+    return token
+
+
+# Function: check_permissions
+# Description: Checks the payload from of the decoded, verified JWT for
+#              permissions. Then compares the user's permissions to the
+#              required permission to check whether the user is allowed to
+#              access the given resource.
+#              If no permission is required, the payload isn't checked.
+# Parameters: permission (string) - The resource's required permission.
+#             payload - The payload from the decoded, verified JWT.
+# Returns: True - Boolean confirming the user has the required permission.
+def check_permissions(permission: str, payload: Mapping) -> bool:
+    # If the resource doesn't require a permission, any user can access it
+    if(not permission):
+        return True
+
+    # If there are no permissions in the payload, raises an AuthError
+    if('permissions' not in payload):
+        raise AuthError(_ERR_FORBIDDEN, 403)
+
+    user_permissions = payload['permissions']
+
+    # If the needed permission isn't in the user's permissions, raises an error
+    if(permission not in user_permissions):
+        raise AuthError(_ERR_FORBIDDEN, 403)
+
+    return True
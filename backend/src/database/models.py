@@ -1,12 +1,17 @@
 import os
-from sqlalchemy import Column, String, Integer
+from datetime import datetime
+from functools import lru_cache
+from typing import List, Optional, Union
+from sqlalchemy import Column, String, Integer, DateTime, JSON, Text, cast
+from sqlalchemy.dialects.postgresql import JSONB
 from flask_sqlalchemy import SQLAlchemy
-import json
+import msgspec
 
 database_filename = "database.db"
 project_dir = os.path.dirname(os.path.abspath(__file__))
-database_path = "sqlite:///{}".format(os.path.join(project_dir,
-                                      database_filename))
+# Set DATABASE_URL to use a database server instead of the bundled SQLite file
+database_path = os.environ.get("DATABASE_URL", "sqlite:///{}".format(
+                               os.path.join(project_dir, database_filename)))
 
 db = SQLAlchemy()
 
@@ -16,6 +21,22 @@ db = SQLAlchemy()
 def setup_db(app):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # SQLite file databases open a new connection per checkout, so connection
+    # pooling only applies to database servers. Pooled connections are
+    # recycled after 30 minutes, before the server drops them for idling.
+    if(not database_path.startswith("sqlite")):
+        engine_options = {
+            "pool_size": 20,
+            "max_overflow": 40,
+            "pool_pre_ping": True,
+            "pool_recycle": 1800
+        }
+        # On Postgres, cancel any statement that runs for over 5 seconds
+        if(database_path.startswith("postgres")):
+            engine_options["connect_args"] = {
+                "options": "-c statement_timeout=5000"
+            }
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
     db.app = app
     db.init_app(app)
 
@@ -30,6 +51,91 @@ def db_drop_and_create_all():
     db.create_all()
 
 
+# Ingredient
+#    a single ingredient in a drink's recipe
+class Ingredient(msgspec.Struct):
+    name: str
+    color: str
+    parts: Union[int, float]
+
+
+# ShortIngredient
+#    the parts of an ingredient shown in a drink's short form
+class ShortIngredient(msgspec.Struct):
+    color: str
+    parts: Union[int, float]
+
+
+# DrinkShortSchema
+#    short form representation of a drink
+class DrinkShortSchema(msgspec.Struct):
+    id: int
+    title: str
+    recipe: List[ShortIngredient]
+
+
+# DrinkLongSchema
+#    long form representation of a drink
+class DrinkLongSchema(msgspec.Struct):
+    id: int
+    title: str
+    recipe: List[Ingredient]
+
+
+# NewDrinkPayload
+#    the request body for adding a new drink
+class NewDrinkPayload(msgspec.Struct):
+    title: str
+    recipe: List[Ingredient]
+
+
+# DrinkUpdatePayload
+#    the request body for editing a drink; fields left out are unchanged
+class DrinkUpdatePayload(msgspec.Struct):
+    title: Optional[str] = None
+    recipe: Optional[List[Ingredient]] = None
+
+
+# decoders for the stored recipe blob; the short one skips the
+# ingredients' names while decoding
+short_recipe_decoder = msgspec.json.Decoder(List[ShortIngredient])
+recipe_decoder = msgspec.json.Decoder(List[Ingredient])
+
+
+# short_format(drink_id, title, recipe)
+#    short form representation of a drink, built from its column values
+#    (with the recipe as raw JSON text) so that callers can skip loading
+#    full Drink instances
+def short_format(drink_id, title, recipe):
+    return DrinkShortSchema(id=drink_id, title=title,
+                            recipe=short_recipe_decoder.decode(recipe))
+
+
+# long_format(drink_id, title, recipe)
+#    long form representation of a drink, built from its column values
+#    (with the recipe as raw JSON text) so that callers can skip loading
+#    full Drink instances
+def long_format(drink_id, title, recipe):
+    return DrinkLongSchema(id=drink_id, title=title,
+                           recipe=recipe_decoder.decode(recipe))
+
+
+# cached_short_format(drink_id, updated_at, title, recipe)
+# cached_long_format(drink_id, updated_at, title, recipe)
+#    memoised versions of short_format and long_format, keyed by the
+#    drink's id and last update time (along with its values), so every
+#    edit produces a new key and an outdated entry is never returned
+#    !!NOTE the returned structs are shared, so they must not be modified
+@lru_cache(maxsize=4096)
+def cached_short_format(drink_id, updated_at, title, recipe):
+    return short_format(drink_id, title, recipe)
+
+
+@lru_cache(maxsize=4096)
+def cached_long_format(drink_id, updated_at, title, recipe):
+    return long_format(drink_id, title, recipe)
+
+
 # Drink
 # a persistent drink entity, extends the base SQLAlchemy Model
 class Drink(db.Model):
@@ -37,35 +143,31 @@ class Drink(db.Model):
     id = Column(Integer().with_variant(Integer, "sqlite"), primary_key=True)
     # String Title
     title = Column(String(80), unique=True)
-    # the ingredients blob - this stores a lazy json blob
+    # the ingredients - a JSON column (JSONB on Postgres)
     # the required datatype is:
     # [{'color': string, 'name':string, 'parts':number}]
-    recipe = Column(String(180), nullable=False)
+    recipe = Column(JSON().with_variant(JSONB, "postgresql"), nullable=False)
+    # the time of the drink's last change, set on insert and update
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow,
+                        onupdate=datetime.utcnow)
 
     '''
     short()
         short form representation of the Drink model
     '''
     def short(self):
-        print(json.loads(self.recipe))
-        short_recipe = [{"color": r["color"], "parts": r["parts"]}
-                        for r in json.loads(self.recipe)]
-        return {
-            "id": self.id,
-            "title": self.title,
-            "recipe": short_recipe
-        }
+        return DrinkShortSchema(id=self.id, title=self.title,
+                                recipe=msgspec.convert(self.recipe,
+                                                       List[ShortIngredient]))
 
     '''
     long()
         long form representation of the Drink model
     '''
     def long(self):
-        return {
-            "id": self.id,
-            "title": self.title,
-            "recipe": json.loads(self.recipe)
-        }
+        return DrinkLongSchema(id=self.id, title=self.title,
+                               recipe=msgspec.convert(self.recipe,
+                                                      List[Ingredient]))
 
     '''
     insert()
@@ -92,6 +194,21 @@ class Drink(db.Model):
         db.session.delete(self)
         db.session.commit()
 
+    '''
+    delete_by_id()
+        deletes the drink with the given id from the database using a single
+        DELETE statement, without loading the drink first
+        returns the number of deleted rows (0 if there's no such drink)
+        EXAMPLE
+            deleted = Drink.delete_by_id(drink_id)
+    '''
+    @classmethod
+    def delete_by_id(cls, drink_id):
+        deleted = cls.query.filter(cls.id == drink_id).delete(
+            synchronize_session=False)
+        db.session.commit()
+        return deleted
+
     '''
     update()
         updates a new model into a database
@@ -105,4 +222,15 @@ class Drink(db.Model):
         db.session.commit()
 
     def __repr__(self):
-        return json.dumps(self.short())
+        return msgspec.json.encode(self.short()).decode()
+
+
+# drink_rows()
+#    gets every drink's id, last update time, title and recipe - the
+#    arguments of cached_short_format and cached_long_format - without
+#    creating Drink objects
+#    the recipe is cast to text so it isn't deserialised; on a cache hit
+#    it's never parsed at all
+def drink_rows():
+    return db.session.query(Drink.id, Drink.updated_at, Drink.title,
+                            cast(Drink.recipe, Text)).all()
@@ -0,0 +1,23 @@
+# WSGI entry point for running the server with Gunicorn's gevent workers:
+#    gunicorn -k gevent -w 3 --worker-connections 1000 wsgi:app
+# The standard library has to be monkey-patched before anything else is
+# imported, so that blocking socket calls yield to other greenlets.
+from gevent import monkey
+monkey.patch_all()
+
+# psycopg2 is a C extension, so it needs its own patch to cooperate with
+# gevent. It's only installed when DATABASE_URL points to a Postgres server.
+try:
+    from psycogreen.gevent import patch_psycopg
+except ImportError:
+    pass
+else:
+    patch_psycopg()
+
+from src.api import app  # noqa: E402
+from src.auth.auth import prewarm_jwks  # noqa: E402
+
+# Each worker fetches the JWKS on startup instead of on its first
+# authenticated request. This isn't done in src.api, so that importing the
+# app (e.g. for 'flask init-db') doesn't wait on Auth0.
+prewarm_jwks()